@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Automatically record signals from satellite transits
 # Copyright (C) 2014 Tito Dal Canton
@@ -17,48 +17,136 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import os
 import time
-import subprocess
+import selectors
+import signal
 import logging
-import urllib2
-import itertools
+import urllib.request
+import urllib.error
+import json
 import math
-import ConfigParser
+import concurrent.futures
+import configparser
+import dataclasses
+import heapq
+import itertools
+import numpy
 import ephem
+from sgp4.api import Satrec, SatrecArray
+
+
+# WGS84 equatorial radius (km) and flattening
+earth_radius = 6378.137
+earth_flattening = 1 / 298.257223563
+
+# offset between ephem dates (Dublin Julian days) and Julian dates
+ephem_julian_offset = 2415020.
+
+rad2deg = 180. / math.pi
+
+
+class Lazy:
+    "Defers a function call until its result is formatted into a log message."
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+@dataclasses.dataclass(frozen=True)
+class SatelliteConfig:
+    "Settings of a satellite to monitor, from a [sat:<name>] section."
+
+    name: str
+    tle_label: str
+    tle_file: str
+    frequency: float
+
+    @classmethod
+    def from_section(cls, section):
+        return cls(name=section.name.replace('sat:', '', 1),
+                   tle_label=section['tle_label'],
+                   tle_file=section['tle_file'],
+                   frequency=section.getfloat('frequency'))
+
+
+def parse_cpu_list(text):
+    """Parse a list of CPU numbers and ranges like "0,2-3"."""
+    cpus = set()
+    for item in text.split(','):
+        first, _, last = item.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return frozenset(cpus)
+
+
+@dataclasses.dataclass(frozen=True)
+class ReceiverConfig:
+    "Settings of the receiver, from the [receiver] section. Angles in radians."
+
+    latitude: float
+    longitude: float
+    elevation: float
+    horizon: float
+    output_path: str
+    in_process: bool
+    record_iq: bool
+    receiver_cpus: frozenset
+    scheduler_cpus: frozenset
+    realtime_priority: int
+
+    @classmethod
+    def from_section(cls, section):
+        return cls(latitude=float(ephem.degrees(section['latitude'])),
+                   longitude=float(ephem.degrees(section['longitude'])),
+                   elevation=section.getfloat('elevation'),
+                   horizon=float(ephem.degrees(section['horizon'])),
+                   output_path=section['output_path'],
+                   in_process=section.getboolean('in_process', fallback=False),
+                   record_iq=section.getboolean('record_iq', fallback=True),
+                   receiver_cpus=parse_cpu_list(section['receiver_cpus'])
+                                 if 'receiver_cpus' in section else frozenset(),
+                   scheduler_cpus=parse_cpu_list(section['scheduler_cpus'])
+                                  if 'scheduler_cpus' in section else frozenset(),
+                   realtime_priority=section.getint('realtime_priority', fallback=0))
+
+
+def read_config(path):
+    """Parse and validate the configuration file, returning the receiver
+    settings and the list of satellite settings."""
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise RuntimeError('Cannot read configuration file %s' % path)
+    try:
+        receiver = ReceiverConfig.from_section(parser['receiver'])
+        satellites = [SatelliteConfig.from_section(parser[section])
+                      for section in parser.sections()
+                      if section.startswith('sat:')]
+    except (KeyError, ValueError) as e:
+        raise RuntimeError('Invalid configuration file %s: %s' % (path, e)) from e
+    return receiver, satellites
 
 
 class Satellite:
     tle_url_base = 'http://celestrak.com/NORAD/elements/'
 
-    def __init__(self, tle_name, tle_url, frequency, output_prefix):
-        self.tle_name = tle_name
-        self.output_prefix = output_prefix
-        self.frequency = frequency
-        self.next_check_time = ephem.now()
-
-        # download TLE list
-        tle_fd = urllib2.urlopen(self.tle_url_base + tle_url)
-        tle_list = []
-        for line, i in zip(tle_fd, itertools.cycle(xrange(3))):
-            if i == 0:
-                tle_list.append([])
-            tle_list[-1].append(line.strip())
-        
-        # scan TLEs for this satellite
-        self.tle = None
-        for tle in tle_list:
-            if tle[0] == tle_name:
-                self.tle = tle[1:]
-                break
-        if self.tle is None:
-            raise RuntimeError('TLE "%s" not found' % tle_name)
-        
-        # init ephem body object
-        self.body = ephem.readtle(tle_name, self.tle[0], self.tle[1])
+    def __init__(self, config):
+        self.tle_name = config.tle_label
+        self.tle_url = config.tle_file
+        self.output_prefix = config.name
+        self.frequency = config.frequency
+        # end of the last pass found for this satellite
+        self.scheduled_until = ephem.Date(0)
 
-    def next_pass(self, observer):
-        np = observer.next_pass(self.body)
-        return Pass(np, self)
+    def load_tle(self):
+        """Set up the orbit model from the TLE of this satellite."""
+        self.tle = get_tle(self.tle_url, self.tle_name)
+        # the models of all satellites are propagated together, see
+        # build_satrec_array()
+        self.satrec = Satrec.twoline2rv(self.tle[0], self.tle[1])
 
     def __str__(self):
         return self.output_prefix
@@ -67,137 +155,621 @@ class Satellite:
 class Pass:
     "Models a satellite pass."
 
-    def __init__(self, ephem_pass, sat):
-        self.interesting = True
-        self.begin = ephem_pass[0]
-        self.tca = ephem_pass[2]
-        self.end = ephem_pass[4]
-        self.max_elevation = float(ephem_pass[3]) * 180. / math.pi
-        if self.begin <= ephem.now():
-            self.interesting = False
-        if self.max_elevation < 35.:
-            self.interesting = False
-        if self.end <= self.begin:
-            # happens when pass is ongoing
-            self.interesting = False
+    def __init__(self, sat, begin, tca, end, max_elevation):
         self.sat = sat
-        self.status = 'future'
-    
-    def set_status(self, status):
-        self.status = status
+        self.begin = ephem.Date(begin)
+        self.tca = ephem.Date(tca)
+        self.end = ephem.Date(end)
+        self.max_elevation = float(max_elevation) * rad2deg
+        self.interesting = self.max_elevation >= 35.
+
+    def set_clock(self, now, now_monotonic):
+        """Express the begin and end of the pass on the time.monotonic()
+        clock, given the current time as ephem date and on that clock, so
+        that adjustments of the system clock do not affect the schedule."""
+        self.begin_monotonic = now_monotonic + (self.begin - now) / ephem.second
+        self.end_monotonic = now_monotonic + (self.end - now) / ephem.second
+
+
+class Schedule:
+    """Keeps track of the scheduled passes, grouped by status. Each group is
+    a heap ordered by the time of the next transition of its passes: begin
+    for future and deferred passes, end for receiving ones, on the
+    time.monotonic() clock."""
+
+    def __init__(self):
+        self.future = []
+        self.deferred = []
+        self.receiving = []
+        # tie breaker, so that passes themselves are never compared
+        self.counter = itertools.count()
+
+    def push(self, heap, key, p):
+        heapq.heappush(heap, (key, next(self.counter), p))
+
+    def pop_before(self, heap, t):
+        """Remove and return the passes of a heap whose key is before t."""
+        popped = []
+        while heap and heap[0][0] < t:
+            popped.append(heapq.heappop(heap)[2])
+        return popped
+
+    def add(self, p):
+        self.push(self.future, p.begin_monotonic, p)
+
+    def defer(self, p):
+        self.push(self.deferred, p.begin_monotonic, p)
+
+    def receive(self, p):
+        self.push(self.receiving, p.end_monotonic, p)
+
+    def next_transition(self):
+        """Return the earliest begin of a future pass or end of a receiving
+        pass, or None if there are none."""
+        times = [heap[0][0] for heap in (self.future, self.receiving) if heap]
+        return min(times) if times else None
 
 
 class Receiver:
     "Models a program that can record a frequency band to a file."
 
-    def __init__(self, latitude, longitude, elevation, horizon, output_base):
-        self.proc = None
+    # receivers whose process has not been reaped yet, by PID
+    by_pid = {}
+
+    @classmethod
+    def reap_processes(cls):
+        """Collect the receiver processes which have exited, without
+        blocking. Called by the monitor after being woken up by SIGCHLD."""
+        while cls.by_pid:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            receiver = cls.by_pid.pop(pid, None)
+            if receiver is not None:
+                receiver.process_exited(os.waitstatus_to_exitcode(status))
+
+    def __init__(self, config):
+        self.pid = None
+        self.stopping = False
+        self.flowgraph = None
+        self.flowgraph_running = False
+        self.in_process = config.in_process
+        self.record_iq = config.record_iq
+        self.cpus = config.receiver_cpus
+        self.realtime_priority = config.realtime_priority
         self.frequency = None
-        self.observer = ephem.Observer()
-        self.observer.lat = ephem.degrees(latitude)
-        self.observer.long = ephem.degrees(longitude)
-        self.observer.elevation = float(elevation)
-        self.observer.horizon = ephem.degrees(horizon)
-        self.output_base = output_base
+        # the receiver does not move, so its position and local frame in
+        # Earth-fixed coordinates are calculated once
+        self.position, self.enu = topocentric_frame(
+                config.latitude, config.longitude, config.elevation)
+        self.output_base = config.output_path
 
     def start(self, frequency, prefix):
         self.frequency = frequency
         now = time.strftime('%Y%m%d-%H%M%S')
-        self.iq_file_path = '%s/%s-%s-iq.wav' % (self.output_base, prefix, now)
+        if self.record_iq:
+            self.iq_file_path = '%s/%s-%s-iq.wav' % (self.output_base, prefix, now)
+        else:
+            # the baseband stream is several times larger than the
+            # demodulated audio, so skip writing it when it is not wanted
+            self.iq_file_path = os.devnull
         self.demod_file_path = '%s/%s-%s-demod.wav' % (self.output_base, prefix, now)
+        if self.in_process:
+            self.start_flowgraph()
+            return
         args = ['./noaa_apt_rec.py',
-                '--frequency', frequency,
+                '--frequency', str(frequency),
                 '--output-path', self.demod_file_path,
                 '--iq-output-path', self.iq_file_path]
-        self.proc = subprocess.Popen(args)
+        # posix_spawn() can use vfork(), which avoids copying the page
+        # tables of this process like fork() does
+        pid = None
+        if self.realtime_priority:
+            # the policy is set before exec, so all threads of GNU Radio
+            # inherit it
+            try:
+                pid = os.posix_spawn(args[0], args, os.environ,
+                                     scheduler=(os.SCHED_FIFO,
+                                                os.sched_param(self.realtime_priority)))
+            except OSError as e:
+                # needs root or CAP_SYS_NICE
+                logging.warning('Cannot set realtime priority of receiver: %s', e)
+        if pid is None:
+            pid = os.posix_spawn(args[0], args, os.environ)
+        self.pid = pid
+        Receiver.by_pid[self.pid] = self
+        self.set_affinity()
+
+    def set_affinity(self):
+        """Move the receiver process to its own CPUs, so that the scheduler
+        cannot cause dropouts. This can only be done once the process is
+        running, so threads it has already started keep the CPUs of this
+        process."""
+        if self.cpus:
+            try:
+                os.sched_setaffinity(self.pid, self.cpus)
+            except OSError as e:
+                logging.warning('Cannot set CPU affinity of receiver: %s', e)
+
+    def start_flowgraph(self):
+        """Run the receiver flowgraph in this process, reusing it across
+        passes to avoid paying the startup cost of GNU Radio every time."""
+        if self.flowgraph is None:
+            # generated by GNU Radio Companion from noaa_apt_rec.grc
+            import noaa_apt_rec
+            self.flowgraph = noaa_apt_rec.noaa_apt_rec(
+                    frequency=self.frequency,
+                    output_path=self.demod_file_path,
+                    iq_output_path=self.iq_file_path)
+        else:
+            self.flowgraph.set_frequency(self.frequency)
+            self.flowgraph.set_output_path(self.demod_file_path)
+            self.flowgraph.set_iq_output_path(self.iq_file_path)
+        self.flowgraph.start()
+        self.flowgraph_running = True
 
     def stop(self):
-        self.proc.terminate()
-        self.proc.wait()
-        if not self.proc.returncode in [0, -15]:
+        if self.in_process:
+            self.flowgraph.stop()
+            self.flowgraph.wait()
+            # finalize the WAV files now rather than at the next pass
+            self.flowgraph.blocks_wavfile_sink_0.close()
+            self.flowgraph.blocks_wavfile_sink_1.close()
+            self.flowgraph_running = False
+            self.frequency = None
+            return
+        # the process is reaped by reap_processes() once it has exited;
+        # until then the receiver is still busy
+        os.kill(self.pid, signal.SIGTERM)
+        self.stopping = True
+        self.frequency = None
+
+    def process_exited(self, returncode):
+        if not self.stopping:
+            logging.warning('Receiver process exited unexpectedly with code %d',
+                            returncode)
+        elif not returncode in [0, -15]:
             # for unknown reasons, normal termination returns -15
             logging.warning('Receiver process terminated with code %d',
-                            self.proc.returncode)
-        self.proc = None
+                            returncode)
+        self.pid = None
+        self.stopping = False
         self.frequency = None
 
     def running(self):
-        return not (self.proc is None)
+        return self.pid is not None or self.flowgraph_running
+
+
+def parse_tle_file(tle_lines):
+    """Return a dict mapping each satellite name in a TLE file to its two
+    element lines."""
+    lines = [line.strip() for line in tle_lines]
+    return {lines[i]: (lines[i + 1], lines[i + 2])
+            for i in range(0, len(lines) - 2, 3)}
+
+
+def fetch_tle_file(tle_url):
+    """Download and index a TLE file from Celestrak. Files are cached on
+    disk and only requested again, with a conditional GET, after
+    tle_update_interval has passed."""
+    path = os.path.join(cache_dir, 'tle', tle_url)
+    info_path = path + '.json'
+    try:
+        with open(info_path) as info_file:
+            info = json.load(info_file)
+    except (OSError, ValueError):
+        info = {}
+    if not os.path.exists(path):
+        info = {}
+
+    if time.time() - info.get('checked', 0) > tle_update_interval:
+        request = urllib.request.Request(Satellite.tle_url_base + tle_url)
+        if info.get('etag'):
+            request.add_header('If-None-Match', info['etag'])
+        if info.get('last_modified'):
+            request.add_header('If-Modified-Since', info['last_modified'])
+        checked = True
+        try:
+            with urllib.request.urlopen(request, timeout=tle_fetch_timeout) as response:
+                body = response.read()
+                info['etag'] = response.headers.get('ETag')
+                info['last_modified'] = response.headers.get('Last-Modified')
+        except (urllib.error.URLError, OSError) as e:
+            if not info:
+                raise
+            # 304 means that the cached copy is still current, otherwise
+            # keep using it and try again at the next start
+            if not isinstance(e, urllib.error.HTTPError) or e.code != 304:
+                logging.warning('Cannot update %s, using cached copy %.1f days old: %s',
+                                tle_url, (time.time() - info['checked']) / 86400., e)
+                checked = False
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as tle_file:
+                tle_file.write(body)
+            os.replace(path + '.tmp', path)
+        if checked:
+            info['checked'] = time.time()
+            with open(info_path, 'w') as info_file:
+                json.dump(info, info_file)
+
+    with open(path) as tle_file:
+        return parse_tle_file(tle_file.read().splitlines())
+
+
+def fetch_tle_files(tle_urls, max_workers=4):
+    """Download the given TLE files in parallel into tle_indexes, fetching
+    each distinct file only once."""
+    tle_urls = sorted(set(tle_urls) - set(tle_indexes))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        tle_indexes.update(zip(tle_urls, executor.map(fetch_tle_file, tle_urls)))
 
 
+def get_tle(tle_url, tle_name):
+    """Return the two element lines of a satellite from a TLE file."""
+    if tle_url not in tle_indexes:
+        fetch_tle_files([tle_url])
+    try:
+        return tle_indexes[tle_url][tle_name]
+    except KeyError:
+        raise RuntimeError('TLE "%s" not found in %s' % (tle_name, tle_url)) from None
+
+
+def greenwich_sidereal_time(jd):
+    """Return the Greenwich mean sidereal time (IAU 1982 model, in radians)
+    at the given array of Julian dates."""
+    tut1 = (jd - 2451545.) / 36525.
+    seconds = (67310.54841 + (876600. * 3600. + 8640184.812866) * tut1
+               + 0.093104 * tut1 ** 2 - 6.2e-6 * tut1 ** 3)
+    return numpy.radians(seconds / 240.) % (2 * math.pi)
+
+
+def topocentric_frame(lat, lon, elevation):
+    """Return the Earth-fixed position (km) of a site at the given geodetic
+    latitude and longitude (rad) and elevation (m), and the rotation matrix
+    from Earth-fixed to local east-north-up coordinates."""
+    e2 = earth_flattening * (2 - earth_flattening)
+    n = earth_radius / math.sqrt(1 - e2 * math.sin(lat) ** 2)
+    h = elevation / 1000.
+    position = numpy.array([(n + h) * math.cos(lat) * math.cos(lon),
+                            (n + h) * math.cos(lat) * math.sin(lon),
+                            (n * (1 - e2) + h) * math.sin(lat)])
+    enu = numpy.array([
+            [-math.sin(lon), math.cos(lon), 0.],
+            [-math.sin(lat) * math.cos(lon), -math.sin(lat) * math.sin(lon),
+             math.cos(lat)],
+            [math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon),
+             math.sin(lat)]])
+    return position, enu
+
+
+def build_satrec_array(satellites):
+    """Collect the SGP4 models of the given satellites into a single
+    SatrecArray, so that they can be propagated together. Each satellite
+    gets the index of its model in the array."""
+    for i, sat in enumerate(satellites):
+        sat.sgp4_index = i
+    return SatrecArray([sat.satrec for sat in satellites])
+
+
+def update_orbits(satellites, satrec_array):
+    """Reload the TLEs of the satellites, downloading them again if the
+    cached files are old enough, and return a new SatrecArray. If this
+    fails, keep using the given SatrecArray, unless there is none yet."""
+    old_indexes = dict(tle_indexes)
+    tle_indexes.clear()
+    try:
+        fetch_tle_files([sat.tle_url for sat in satellites])
+        # make sure every TLE is there before replacing any model
+        for sat in satellites:
+            get_tle(sat.tle_url, sat.tle_name)
+    except (OSError, RuntimeError, ValueError) as e:
+        if satrec_array is None:
+            raise
+        logging.warning('Cannot update TLEs, keeping the old ones: %s', e)
+        tle_indexes.clear()
+        tle_indexes.update(old_indexes)
+        return satrec_array
+    for sat in satellites:
+        sat.load_tle()
+    return build_satrec_array(satellites)
+
+
+def elevations(satrec_array, receiver, times):
+    """Return the elevation (rad) of each satellite of a SatrecArray above
+    the receiver at each of the given ephem dates, as an array of shape
+    (number of satellites, len(times)). All orbits are propagated by a
+    single vectorized SGP4 call."""
+    jd = numpy.asarray(times, dtype=float) + ephem_julian_offset
+    jd_whole = numpy.floor(jd)
+    errors, teme, _ = satrec_array.sgp4(jd_whole, jd - jd_whole)
+
+    # rotate from the TEME frame to the Earth-fixed frame
+    gmst = greenwich_sidereal_time(jd)
+    cos_gmst, sin_gmst = numpy.cos(gmst), numpy.sin(gmst)
+    sat_position = numpy.stack([
+            cos_gmst * teme[..., 0] + sin_gmst * teme[..., 1],
+            -sin_gmst * teme[..., 0] + cos_gmst * teme[..., 1],
+            teme[..., 2]], axis=-1)
+
+    # rotate the line of sight to east-north-up coordinates
+    topocentric = numpy.tensordot(sat_position - receiver.position,
+                                  receiver.enu, axes=([-1], [1]))
+    elevation = numpy.arcsin(topocentric[..., 2]
+                             / numpy.linalg.norm(topocentric, axis=-1))
+    # orbits which SGP4 cannot propagate are never visible
+    elevation[errors != 0] = -math.pi / 2
+    return elevation
+
+
+def refine_crossings(satrec_array, receiver, before, after):
+    """Bisect the times at which a satellite crosses pass_horizon,
+    given arrays of ephem dates bracketing each crossing. The satellite is
+    given as a single-element SatrecArray."""
+    before = numpy.array(before, dtype=float)
+    after = numpy.array(after, dtype=float)
+    above_before = elevations(satrec_array, receiver, before)[0] > pass_horizon
+    while (after - before).max() > crossing_tolerance:
+        middle = (before + after) / 2
+        above_middle = elevations(satrec_array, receiver, middle)[0] > pass_horizon
+        same = above_middle == above_before
+        before = numpy.where(same, middle, before)
+        after = numpy.where(same, after, middle)
+    return (before + after) / 2
+
+
+def refine_culminations(satrec_array, receiver, before, after):
+    """Find by golden section search the times at which a satellite reaches
+    its maximum elevation, given arrays of ephem dates bracketing each
+    maximum. Return the times and the maximum elevations. The satellite is
+    given as a single-element SatrecArray."""
+    before = numpy.array(before, dtype=float)
+    after = numpy.array(after, dtype=float)
+    ratio = (math.sqrt(5) - 1) / 2
+    while (after - before).max() > crossing_tolerance:
+        left = after - ratio * (after - before)
+        right = before + ratio * (after - before)
+        rising = (elevations(satrec_array, receiver, left)[0]
+                  < elevations(satrec_array, receiver, right)[0])
+        before = numpy.where(rising, left, before)
+        after = numpy.where(rising, after, right)
+    tca = (before + after) / 2
+    return tca, elevations(satrec_array, receiver, tca)[0]
+
+
+def find_passes(satellites, satrec_array, receiver, start, end):
+    """Return the passes of the given satellites over the receiver which
+    begin and end between two ephem dates. Elevations are sampled on a grid
+    with a single vectorized SGP4 call for all satellites; rise and set
+    times and culminations are then refined around the samples."""
+    times = start + numpy.arange(0., end - start, pass_search_step)
+    elevation = elevations(satrec_array, receiver, times)
+    above = elevation > pass_horizon
+    passes = []
+    for sat in satellites:
+        sat_elevation = elevation[sat.sgp4_index]
+        sat_above = above[sat.sgp4_index]
+        # index of the last sample before each rise or set
+        crossings = numpy.flatnonzero(sat_above[1:] != sat_above[:-1])
+        if sat_above[0]:
+            # pass in progress at the start
+            crossings = crossings[1:]
+        rises, sets = crossings[0::2], crossings[1::2]
+        # the last pass may not have ended yet
+        rises = rises[:len(sets)]
+        if not len(rises):
+            continue
+
+        sat_array = SatrecArray([sat.satrec])
+        begins = refine_crossings(sat_array, receiver, times[rises], times[rises + 1])
+        ends = refine_crossings(sat_array, receiver, times[sets], times[sets + 1])
+        peaks = numpy.array([rise + 1 + sat_elevation[rise + 1:set_ + 1].argmax()
+                             for rise, set_ in zip(rises, sets)])
+        tcas, max_elevations = refine_culminations(
+                sat_array, receiver, times[peaks - 1], times[peaks + 1])
+        for pass_times in zip(begins, tcas, ends, max_elevations):
+            passes.append(Pass(sat, *pass_times))
+    passes.sort(key=lambda p: p.begin)
+    return passes
+
+
+def next_event_time(next_search_time, schedule, receiver):
+    """Return the earliest time, on the time.monotonic() clock, at which the
+    monitor has something to do."""
+    if schedule.deferred and not receiver.running():
+        return time.monotonic()
+    events = [time.monotonic() + max_sleep_time]
+    # searches wait for the receiver to be free
+    if not receiver.running():
+        events.append(next_search_time)
+    if schedule.next_transition() is not None:
+        events.append(schedule.next_transition())
+    return min(events)
+
+
+def request_stop(signum, frame):
+    global stop_requested
+    logging.info('Received signal %d, exiting', signum)
+    stop_requested = True
+
+
+def make_wakeup_selector():
+    """Return a selector watching the read end of a self-pipe which receives
+    a byte whenever a signal (e.g. SIGCHLD from the receiver process) is
+    delivered. SIGINT and SIGTERM also wake it up and request a clean
+    exit."""
+    rfd, wfd = os.pipe()
+    os.set_blocking(rfd, False)
+    os.set_blocking(wfd, False)
+    signal.set_wakeup_fd(wfd)
+    # the wakeup fd is only written to for signals having a Python handler
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    selector = selectors.DefaultSelector()
+    selector.register(rfd, selectors.EVENT_READ)
+    return selector
+
+
+def sleep_until(deadline, selector):
+    """Sleep until the given time.monotonic() time, or until a signal
+    arrives."""
+    delay = min(max(0., deadline - time.monotonic()), max_sleep_time)
+    for key, _ in selector.select(delay):
+        try:
+            os.read(key.fd, 4096)
+        except BlockingIOError:
+            pass
+
+
+# longest time (in seconds) the monitor sleeps without checking the schedule
+max_sleep_time = 60.
+
+# largest drift (in seconds) between the system clock and time.monotonic()
+# before the system clock is considered stepped and passes searched again
+clock_step_tolerance = 5.
+
+# time step of the grid over which satellite elevations are sampled to find
+# passes, and precision of the rise and set times
+pass_search_step = 30 * ephem.second
+crossing_tolerance = 0.1 * ephem.second
+
+# elevation (rad) at which passes begin and end, so that whole passes are
+# recorded; the horizon setting of the receiver was never applied to this,
+# as PyEphem's next_pass() ignores it
+pass_horizon = 0.
+
+# how often to search for passes, and how far ahead; searches overlap so
+# that a pass cut by the end of a search is found by the next one
+pass_search_interval = ephem.hour * 24
+pass_search_window = pass_search_interval + 2 * ephem.hour
+
+# where to keep data which can be reused across runs
+cache_dir = os.path.expanduser('~/.cache/sarchiapone')
+
+# how often (in seconds) to check for new TLE files
+tle_update_interval = 86400.
+
+# how long to wait (in seconds) for Celestrak before giving up on a TLE file
+tle_fetch_timeout = 30.
+
+# set by SIGINT or SIGTERM to leave the main loop
+stop_requested = False
+
+# TLE files loaded so far, mapping each file to a dict from satellite names
+# to element lines
+tle_indexes = {}
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s',
                     datefmt='%F %T')
 
 logging.info('Reading configuration')
-config = ConfigParser.ConfigParser()
-config.read(sys.argv[1])
+receiver_config, satellite_configs = read_config(sys.argv[1])
 
 # load satellites to monitor
-satellites = []
-for section in config.sections():
-    if section.startswith('sat:'):
-        sat = Satellite(config.get(section, 'tle_label'),
-                        config.get(section, 'tle_file'),
-                        config.get(section, 'frequency'),
-                        section.replace('sat:', ''))
-        satellites.append(sat)
+satellites = [Satellite(sat_config) for sat_config in satellite_configs]
+# orbits are loaded, and then refreshed, before each search for passes
+satrec_array = None
 
 # load receiver definition
-receiver = Receiver(config.get('receiver', 'latitude'),
-                    config.get('receiver', 'longitude'),
-                    config.get('receiver', 'elevation'),
-                    config.get('receiver', 'horizon'),
-                    config.get('receiver', 'output_path'))
+receiver = Receiver(receiver_config)
 
-passes = []
+# keep the scheduler off the CPUs of the receiver
+if receiver_config.scheduler_cpus:
+    try:
+        os.sched_setaffinity(0, receiver_config.scheduler_cpus)
+    except OSError as e:
+        logging.warning('Cannot set CPU affinity of scheduler: %s', e)
+
+schedule = Schedule()
+next_search_time = time.monotonic()
+# time of the last search for passes, as ephem date and on time.monotonic()
+search_t = search_monotonic = None
+wakeup_selector = make_wakeup_selector()
 
 logging.info('Starting monitor')
-while True:
-    t = ephem.now()
+while not stop_requested:
+    Receiver.reap_processes()
+    now = time.monotonic()
 
-    # calculate new passes if needed
-    receiver.observer.date = t
-    for sat in satellites:
-        if t > sat.next_check_time:
-            np = sat.next_pass(receiver.observer)
+    # passes are scheduled on time.monotonic() from the system clock at the
+    # time of the search, so if the system clock has been stepped since then
+    # (e.g. by NTP after a boot without RTC) the future ones must be found
+    # again; passes being received or deferred are kept
+    if search_t is not None:
+        step = (ephem.now() - search_t) / ephem.second - (now - search_monotonic)
+        if abs(step) > clock_step_tolerance:
+            logging.warning('System clock stepped by %.1f s, searching passes again', step)
+            schedule.future.clear()
+            for sat in satellites:
+                sat.scheduled_until = ephem.Date(0)
+            for heap in (schedule.deferred, schedule.receiving):
+                for _, _, p in heap:
+                    p.sat.scheduled_until = max(p.sat.scheduled_until, p.end)
+            next_search_time = now
+
+    # search for new passes once in a while; updating the orbits may need
+    # the network, so wait until the receiver is free to avoid delaying the
+    # end of a pass
+    if now >= next_search_time and not receiver.running():
+        satrec_array = update_orbits(satellites, satrec_array)
+        # updating the orbits may have taken a while
+        t, now = ephem.now(), time.monotonic()
+        search_t, search_monotonic = t, now
+        window_end = ephem.Date(t + pass_search_window)
+        for np in find_passes(satellites, satrec_array, receiver, t, window_end):
+            sat = np.sat
+            if np.begin <= sat.scheduled_until:
+                # already found by the previous search
+                continue
+            sat.scheduled_until = np.end
+            np.set_clock(t, now)
             if np.interesting:
                 logging.info('%s: interesting pass with TCA %s and max altitude %f, scheduling',
-                             sat, ephem.localtime(np.tca), np.max_elevation)
-                passes.append(np)
+                             sat, Lazy(ephem.localtime, np.tca), np.max_elevation)
+                schedule.add(np)
             else:
-                logging.debug('%s: ongoing or low pass with TCA %s, skipping',
-                              sat, ephem.localtime(np.tca))
-            sat.next_check_time = ephem.Date(np.end + ephem.minute)
-
-    # handle scheduled or active passes
-    for p in passes:
-        if p.status == 'future':
-            if t > p.begin:
-                if receiver.running():
-                    logging.info('%s: raising, receiver busy, deferring reception', p.sat)
-                    p.set_status('deferred')
-                else:
-                    logging.info('%s: raising, starting reception', p.sat)
-                    receiver.start(p.sat.frequency, p.sat.output_prefix)
-                    p.set_status('receiving')
-        elif p.status == 'deferred':
-            if not receiver.running():
-                logging.info('%s: receiver now free, starting reception', p.sat)
-                receiver.start(p.sat.frequency, p.sat.output_prefix)
-                p.set_status('receiving')
-        elif p.status == 'receiving':
-            if t > p.end:
-                if receiver.running():
-                    if receiver.frequency == p.sat.frequency:
-                        logging.info('%s: setting, stopping reception', p.sat)
-                        receiver.stop()
-                    else:
-                        logging.info('%s: setting, pass missed', p.sat)
-                else:
-                    raise RuntimeError('This should not happen!')
-                passes.remove(p)
+                logging.debug('%s: low pass with TCA %s, skipping',
+                              sat, Lazy(ephem.localtime, np.tca))
+        next_search_time = now + pass_search_interval / ephem.second
 
-    try:
-        time.sleep(1)
-    except KeyboardInterrupt:
-        break
+    # stop receiving passes which are over
+    for p in schedule.pop_before(schedule.receiving, now):
+        if receiver.running():
+            if receiver.frequency == p.sat.frequency:
+                logging.info('%s: setting, stopping reception', p.sat)
+                receiver.stop()
+            else:
+                logging.info('%s: setting, pass missed', p.sat)
+        else:
+            logging.warning('%s: setting, receiver had already stopped', p.sat)
+
+    # give a free receiver to the earliest deferred pass which is not over
+    while schedule.deferred and not receiver.running():
+        p = heapq.heappop(schedule.deferred)[2]
+        if p.end_monotonic <= now:
+            logging.info('%s: set while deferred, pass missed', p.sat)
+            continue
+        logging.info('%s: receiver now free, starting reception', p.sat)
+        receiver.start(p.sat.frequency, p.sat.output_prefix)
+        schedule.receive(p)
+
+    # start passes which are beginning
+    for p in schedule.pop_before(schedule.future, now):
+        if receiver.running():
+            logging.info('%s: raising, receiver busy, deferring reception', p.sat)
+            schedule.defer(p)
+        else:
+            logging.info('%s: raising, starting reception', p.sat)
+            receiver.start(p.sat.frequency, p.sat.output_prefix)
+            schedule.receive(p)
+
+    sleep_until(next_event_time(next_search_time, schedule, receiver),
+                wakeup_selector)
+
+if receiver.running():
+    logging.info('Stopping reception')
+    receiver.stop()